@@ -1,14 +1,25 @@
-import base64
 import io
+import json
+import mimetypes
 import os
+import queue
 import sqlite3
-from datetime import datetime
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from pathlib import Path
+from urllib.parse import quote
 
-from flask import Flask, flash, redirect, render_template, request, send_from_directory, url_for
+import cv2
+import requests
+from cachetools import TTLCache
+from flask import Flask, Response, abort, flash, redirect, render_template, request, send_from_directory, url_for
 from flask_login import UserMixin, LoginManager, login_required, current_user, login_user, logout_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 
 from config import Config, allowed_file
@@ -16,10 +27,38 @@ from utils.image_processing import preprocess_receipt
 from utils.ocr_processor import extract_receipt_data
 
 
-# Global variable to store db_path (will be set in create_app)
-db_path = None
+# Settings resolved once in create_app so request handlers read plain module globals
+DB_PATH = None
+UPLOAD_PATH = None
+AZURE_ENDPOINT = ""
+AZURE_KEY = ""
+UPLOADS_ACCEL_PREFIX = ""
+pool = None
 login_manager = LoginManager()
 
+# Uploads are preprocessed and sent to Azure on this pool so request threads stay free.
+# Both stages are I/O bound or run in OpenCV with the GIL released, so threads scale well.
+# Sized from OCR_WORKERS in create_app.
+executor = None
+# Upload jobs keyed by job id as (user_id, future), polled by /status/<job_id>.
+# Entries expire so jobs whose status page is never revisited don't pile up.
+jobs = TTLCache(maxsize=1024, ttl=600)
+jobs_lock = threading.Lock()
+# Encoded preview images for the results page, keyed by preview id then image name.
+# Written by the worker pool and read by request threads, so guarded by a lock.
+previews = TTLCache(maxsize=256, ttl=600)
+previews_lock = threading.Lock()
+# Recently loaded users so @login_required views don't hit the users table on every request.
+# Entries expire so role changes made directly in the database are still picked up.
+user_cache = TTLCache(maxsize=1024, ttl=300)
+user_cache_lock = threading.Lock()
+
+# Used by both the upload worker and manual expenses
+_INSERT_RECEIPT_SQL = (
+	"INSERT INTO receipts (filename, merchant, date, total, tax, items, raw_text, trip_id, user_id) "
+	"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
 
 class User(UserMixin):
 	def __init__(self, id, username, role, truck_number=""):
@@ -31,24 +70,27 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-	if db_path is None:
+	if pool is None:
 		return None
-	conn = get_db_connection(db_path)
-	user_row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-	conn.close()
+	with user_cache_lock:
+		user = user_cache.get(user_id)
+	if user is not None:
+		return user
+	with pool.connection() as conn:
+		# init_db adds truck_number to older databases, so it is always present
+		user_row = conn.execute(
+			"SELECT id, username, role, truck_number FROM users WHERE id = ?", (user_id,)
+		).fetchone()
 	if user_row:
-		# Handle truck_number - it might not exist in older databases
-		truck_number = ''
-		try:
-			truck_number = user_row['truck_number'] or ''
-		except (KeyError, IndexError):
-			pass
-		return User(
+		user = User(
 			id=user_row['id'],
 			username=user_row['username'],
 			role=user_row['role'],
-			truck_number=truck_number
+			truck_number=user_row['truck_number'] or ''
 		)
+		with user_cache_lock:
+			user_cache[user_id] = user
+		return user
 	return None
 
 
@@ -58,84 +100,211 @@ def get_db_connection(db_path: str):
 	return conn
 
 
-def init_db(db_path: str):
-	conn = get_db_connection(db_path)
-	# Create users table
-	conn.execute(
-		"""
-		CREATE TABLE IF NOT EXISTS users (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			username TEXT NOT NULL UNIQUE,
-			password_hash TEXT NOT NULL,
-			role TEXT NOT NULL DEFAULT 'driver'
-		);
-		"""
-	)
-	# Create trips table
-	conn.execute(
-		"""
-		CREATE TABLE IF NOT EXISTS trips (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			name TEXT NOT NULL,
-			user_id INTEGER,
-			FOREIGN KEY (user_id) REFERENCES users(id)
-		);
-		"""
-	)
-	# Create receipts table
+class SQLitePool:
+	"""Fixed set of long-lived SQLite connections shared by all request threads.
+
+	Reusing connections keeps SQLite's page cache warm instead of paying for
+	open/close on every request. The database runs in WAL mode so the readers
+	never block on the single writer connection, which is serialized by a lock.
+	"""
+
+	def __init__(self, db_path: str, size: int = 8):
+		self._readers = queue.Queue(maxsize=size - 1)
+		for _ in range(size - 1):
+			self._readers.put(self._connect(db_path))
+		self._writer = self._connect(db_path)
+		self._write_lock = threading.Lock()
+
+	@staticmethod
+	def _connect(db_path: str) -> sqlite3.Connection:
+		conn = sqlite3.connect(db_path, check_same_thread=False)
+		conn.row_factory = sqlite3.Row
+		conn.execute("PRAGMA journal_mode=WAL")
+		conn.execute("PRAGMA synchronous=NORMAL")
+		conn.execute("PRAGMA cache_size=-20000")  # ~20MB page cache per connection
+		return conn
+
+	@contextmanager
+	def connection(self):
+		"""Borrow a read connection, blocking until one is free."""
+		conn = self._readers.get()
+		try:
+			yield conn
+		finally:
+			if conn.in_transaction:
+				conn.rollback()
+			self._readers.put(conn)
+
+	@contextmanager
+	def writer(self):
+		"""Borrow the writer connection. Callers commit their own changes."""
+		with self._write_lock:
+			try:
+				yield self._writer
+			finally:
+				if self._writer.in_transaction:
+					self._writer.rollback()
+
+
+# created_at is stamped by SQLite as 'YYYY-MM-DD HH:MM:SS' (UTC), which sorts lexicographically
+_RECEIPTS_TABLE_SQL = """
+	CREATE TABLE IF NOT EXISTS receipts (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		filename TEXT,
+		merchant TEXT,
+		date TEXT,
+		total REAL,
+		tax REAL,
+		items TEXT,
+		raw_text TEXT,
+		created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+		trip_id INTEGER,
+		user_id INTEGER,
+		FOREIGN KEY (trip_id) REFERENCES trips(id),
+		FOREIGN KEY (user_id) REFERENCES users(id)
+	);
+"""
+
+
+def owned_receipt(conn, receipt_id: int, user_id: int):
+	"""Return the receipt row if it belongs to user_id, otherwise None."""
+	return conn.execute(
+		"SELECT id, filename, merchant, date, total, tax, trip_id FROM receipts WHERE id = ? AND user_id = ?",
+		(receipt_id, user_id),
+	).fetchone()
+
+
+def _column_names(conn, table: str) -> set:
+	return {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _rebuild_receipts_with_created_default(conn):
+	"""Recreate receipts so created_at defaults to CURRENT_TIMESTAMP.
+
+	SQLite can't change a column default in place. Existing Python isoformat
+	stamps are normalized to SQLite's format so old and new rows sort together.
+	"""
+	columns = "id, filename, merchant, date, total, tax, items, raw_text, created_at, trip_id, user_id"
+	conn.execute("ALTER TABLE receipts RENAME TO receipts_old")
+	conn.execute(_RECEIPTS_TABLE_SQL)
 	conn.execute(
-		"""
-		CREATE TABLE IF NOT EXISTS receipts (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			filename TEXT,
-			merchant TEXT,
-			date TEXT,
-			total REAL,
-			tax REAL,
-			items TEXT,
-			raw_text TEXT,
-			created_at TEXT,
-			trip_id INTEGER,
-			user_id INTEGER,
-			FOREIGN KEY (trip_id) REFERENCES trips(id),
-			FOREIGN KEY (user_id) REFERENCES users(id)
-		);
+		f"""
+		INSERT INTO receipts ({columns})
+		SELECT id, filename, merchant, date, total, tax, items, raw_text,
+			COALESCE(datetime(created_at), created_at, CURRENT_TIMESTAMP), trip_id, user_id
+		FROM receipts_old
 		"""
 	)
-	# Add trip_id column to existing receipts table if it doesn't exist
-	try:
-		conn.execute("ALTER TABLE receipts ADD COLUMN trip_id INTEGER")
-		conn.commit()
-	except sqlite3.OperationalError:
-		# Column already exists, ignore
-		pass
-	# Add user_id column to existing trips table if it doesn't exist
-	try:
-		conn.execute("ALTER TABLE trips ADD COLUMN user_id INTEGER")
-		conn.commit()
-	except sqlite3.OperationalError:
-		# Column already exists, ignore
-		pass
-	# Add user_id column to existing receipts table if it doesn't exist
+	conn.execute("DROP TABLE receipts_old")
+
+
+def init_db(db_path: str):
+	conn = get_db_connection(db_path)
+	# Run the whole schema setup in one explicit transaction so startup commits once
+	with conn:
+		conn.execute("BEGIN")
+		# Create users table
+		conn.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS users (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				username TEXT NOT NULL UNIQUE,
+				password_hash TEXT NOT NULL,
+				role TEXT NOT NULL DEFAULT 'driver'
+			);
+			"""
+		)
+		# Create trips table
+		conn.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS trips (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				name TEXT NOT NULL,
+				user_id INTEGER,
+				FOREIGN KEY (user_id) REFERENCES users(id)
+			);
+			"""
+		)
+		# Create receipts table
+		conn.execute(_RECEIPTS_TABLE_SQL)
+		# Add columns missing from databases created by older versions
+		receipt_columns = _column_names(conn, "receipts")
+		if "trip_id" not in receipt_columns:
+			conn.execute("ALTER TABLE receipts ADD COLUMN trip_id INTEGER")
+		if "user_id" not in _column_names(conn, "trips"):
+			conn.execute("ALTER TABLE trips ADD COLUMN user_id INTEGER")
+		if "user_id" not in receipt_columns:
+			conn.execute("ALTER TABLE receipts ADD COLUMN user_id INTEGER")
+		if "truck_number" not in _column_names(conn, "users"):
+			conn.execute("ALTER TABLE users ADD COLUMN truck_number TEXT DEFAULT ''")
+		# Databases from before created_at had a default need the table rebuilt
+		created_at = next(row for row in conn.execute("PRAGMA table_info(receipts)") if row['name'] == 'created_at')
+		if created_at['dflt_value'] is None:
+			_rebuild_receipts_with_created_default(conn)
+		# Indexes for the per-user listings; history becomes an index range scan with no sort
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_receipts_user_created ON receipts(user_id, created_at DESC)")
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_receipts_trip ON receipts(trip_id)")
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_trips_user ON trips(user_id)")
+		conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+	conn.close()
+
+
+def _process_receipt(original_path: Path, filename: str, trip_id, user_id, http_session: requests.Session) -> dict:
+	"""Preprocess, OCR and store one uploaded receipt. Runs on the worker pool."""
+	# Decode straight from disk so the upload is never held in memory as bytes
+	img_bgr = cv2.imread(str(original_path), cv2.IMREAD_COLOR)
 	try:
-		conn.execute("ALTER TABLE receipts ADD COLUMN user_id INTEGER")
-		conn.commit()
-	except sqlite3.OperationalError:
-		# Column already exists, ignore
-		pass
-	# Add truck_number column to existing users table if it doesn't exist
+		warped_bgr, preprocessed = preprocess_receipt(img_bgr, color=True)
+	except Exception as e:
+		raise RuntimeError(f"Image processing failed: {e}") from e
+
+	# Encode images for display; served from the preview cache rather than inlined as base64
+	_, warped_jpg = cv2.imencode(".jpg", warped_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
+	# The thresholded image is encoded once as lossless PNG (fast zlib level) and the
+	# same bytes go to both the preview and Azure; JPEG artifacts hurt OCR on it
+	_, pre_png = cv2.imencode(".png", preprocessed, [int(cv2.IMWRITE_PNG_COMPRESSION), 1])
+	pre_bytes = pre_png.tobytes()
+	preview_key = uuid.uuid4().hex
+	with previews_lock:
+		previews[preview_key] = {
+			"warped": (warped_jpg.tobytes(), "image/jpeg"),
+			"preprocessed": (pre_bytes, "image/png"),
+		}
+
+	# OCR via Azure
 	try:
-		conn.execute("ALTER TABLE users ADD COLUMN truck_number TEXT DEFAULT ''")
+		data = extract_receipt_data(pre_bytes, AZURE_ENDPOINT, AZURE_KEY, session=http_session)
+	except Exception as e:
+		raise RuntimeError(f"OCR failed: {e}") from e
+
+	# Store in DB
+	with pool.writer() as conn:
+		conn.execute(
+			_INSERT_RECEIPT_SQL,
+			(
+				filename,
+				data.get("merchant", ""),
+				data.get("date", ""),
+				float(data.get("total") or 0),
+				float(data.get("tax") or 0),
+				json.dumps(data.get("items") or [], separators=(",", ":"), ensure_ascii=False),
+				data.get("raw_text", ""),
+				trip_id,
+				user_id,
+			),
+		)
 		conn.commit()
-	except sqlite3.OperationalError:
-		# Column already exists, ignore
-		pass
-	conn.commit()
-	conn.close()
+
+	return {
+		"user_id": user_id,
+		"filename": filename,
+		"preview_key": preview_key,
+		"data": data,
+	}
 
 
 def create_app() -> Flask:
-	global db_path
+	global DB_PATH, UPLOAD_PATH, AZURE_ENDPOINT, AZURE_KEY, UPLOADS_ACCEL_PREFIX, pool, executor
 	app = Flask(__name__, static_folder="static", template_folder="templates")
 	config = Config.from_env()
 	app.config["SECRET_KEY"] = config.SECRET_KEY
@@ -144,18 +313,32 @@ def create_app() -> Flask:
 	
 	# Store config in app for later use
 	app.config_obj = config
+	AZURE_ENDPOINT = config.AZURE_CV_ENDPOINT
+	AZURE_KEY = config.AZURE_CV_KEY
+	UPLOADS_ACCEL_PREFIX = config.UPLOADS_ACCEL_PREFIX.rstrip("/")
 
 	# Initialize LoginManager
 	login_manager.init_app(app)
 	login_manager.login_view = 'login'
 
 	# Ensure upload path exists
-	upload_path = Path(app.root_path) / app.config["UPLOAD_FOLDER"]
-	upload_path.mkdir(parents=True, exist_ok=True)
+	UPLOAD_PATH = Path(app.root_path) / app.config["UPLOAD_FOLDER"]
+	UPLOAD_PATH.mkdir(parents=True, exist_ok=True)
 
 	# Init DB
-	db_path = str(Path(app.root_path) / config.DATABASE_PATH)
-	init_db(db_path)
+	DB_PATH = str(Path(app.root_path) / config.DATABASE_PATH)
+	init_db(DB_PATH)
+	pool = SQLitePool(DB_PATH)
+
+	# One worker per in-flight upload; most of that time is spent waiting on Azure
+	executor = ThreadPoolExecutor(max_workers=config.OCR_WORKERS)
+
+	# Keep-alive HTTP session shared by all OCR calls so TCP+TLS setup is paid once per connection
+	app.http_session = requests.Session()
+	app.http_session.mount(
+		"https://",
+		HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=0.2)),
+	)
 
 	def admin_required(f):
 		@wraps(f)
@@ -180,15 +363,13 @@ def create_app() -> Flask:
 				flash("Username and password are required.", "error")
 				return redirect(url_for('register'))
 			hash = generate_password_hash(password)
-			conn = get_db_connection(db_path)
-			try:
-				conn.execute("INSERT INTO users (username, password_hash, role, truck_number) VALUES (?, ?, ?, ?)", (username, hash, 'driver', truck_number))
-				conn.commit()
-			except sqlite3.IntegrityError:
-				flash("Username already taken.", "error")
-				conn.close()
-				return redirect(url_for('register'))
-			conn.close()
+			with pool.writer() as conn:
+				try:
+					conn.execute("INSERT INTO users (username, password_hash, role, truck_number) VALUES (?, ?, ?, ?)", (username, hash, 'driver', truck_number))
+					conn.commit()
+				except sqlite3.IntegrityError:
+					flash("Username already taken.", "error")
+					return redirect(url_for('register'))
 			flash("Account created, please login.", "success")
 			return redirect(url_for("login"))
 		return render_template("register.html")
@@ -198,9 +379,8 @@ def create_app() -> Flask:
 		if request.method == "POST":
 			username = request.form.get("username", "").strip()
 			password = request.form.get("password", "").strip()
-			conn = get_db_connection(db_path)
-			user_row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-			conn.close()
+			with pool.connection() as conn:
+				user_row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
 			if user_row and check_password_hash(user_row['password_hash'], password):
 				user = User(id=user_row['id'], username=user_row['username'], role=user_row['role'])
 				login_user(user)
@@ -218,28 +398,26 @@ def create_app() -> Flask:
 	@login_required
 	def upload_page():
 		"""Display upload page with trip selection"""
-		conn = get_db_connection(db_path)
-		trips = conn.execute("SELECT id, name FROM trips WHERE user_id = ? ORDER BY name", (current_user.id,)).fetchall()
-		conn.close()
+		with pool.connection() as conn:
+			trips = conn.execute("SELECT id, name FROM trips WHERE user_id = ? ORDER BY name", (current_user.id,)).fetchall()
 		return render_template("upload.html", trips=trips)
 
 	@app.route("/history")
 	@login_required
 	def history():
 		"""Display all previously processed receipts"""
-		conn = get_db_connection(db_path)
-		receipts = conn.execute(
-			"""
-			SELECT r.id, r.filename, r.merchant, r.date, r.total, r.created_at, r.trip_id,
-			       t.name as trip_name
-			FROM receipts r
-			LEFT JOIN trips t ON r.trip_id = t.id
-			WHERE r.user_id = ?
-			ORDER BY r.created_at DESC
-			""",
-			(current_user.id,)
-		).fetchall()
-		conn.close()
+		with pool.connection() as conn:
+			receipts = conn.execute(
+				"""
+				SELECT r.id, r.filename, r.merchant, r.date, r.total, r.created_at, r.trip_id,
+				       t.name as trip_name
+				FROM receipts r
+				LEFT JOIN trips t ON r.trip_id = t.id
+				WHERE r.user_id = ?
+				ORDER BY r.created_at DESC
+				""",
+				(current_user.id,)
+			).fetchall()
 		return render_template("history.html", receipts=receipts)
 
 	# In trip_tally/app.py
@@ -279,80 +457,83 @@ def create_app() -> Flask:
 			flash("Invalid file type.", "error")
 			return redirect(url_for("upload_page"))
 
-		filename = secure_filename(file.filename)
-		# Read bytes for processing first
-		image_bytes = file.read()
-		if not image_bytes:
+		# Prefix a random id so uploads that share a name (phones send every photo as
+		# image.jpg) can't overwrite each other before the worker reads them
+		filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+		# Stream the original upload to disk rather than reading it into memory
+		original_path = UPLOAD_PATH / filename
+		file.save(str(original_path))
+		if original_path.stat().st_size == 0:
+			original_path.unlink()
 			flash("Empty file uploaded.", "error")
 			return redirect(url_for("upload_page"))
 
-		# Save original upload
-		original_path = upload_path / filename
-		with open(original_path, "wb") as f:
-			f.write(image_bytes)
-
-		# Preprocess using OpenCV
-		import numpy as np
-		import cv2
-		np_arr = np.frombuffer(image_bytes, np.uint8)
-		img_bgr = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-		try:
-			warped_bgr, preprocessed = preprocess_receipt(img_bgr)
-		except Exception as e:
-			flash(f"Image processing failed: {e}", "error")
-			return redirect(url_for("upload_page"))
-
-		# Encode images for display
-		_, warped_jpg = cv2.imencode(".jpg", warped_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
-		_, pre_jpg = cv2.imencode(".jpg", preprocessed)
-		warped_b64 = base64.b64encode(warped_jpg.tobytes()).decode("ascii")
-		pre_b64 = base64.b64encode(pre_jpg.tobytes()).decode("ascii")
-
-		# OCR via Azure
-		config = app.config_obj
-		if not config.AZURE_CV_ENDPOINT or not config.AZURE_CV_KEY:
+		if not AZURE_ENDPOINT or not AZURE_KEY:
 			flash("Azure credentials not configured.", "error")
 			return redirect(url_for("upload_page"))
-		try:
-			data = extract_receipt_data(pre_jpg.tobytes(), config.AZURE_CV_ENDPOINT, config.AZURE_CV_KEY)
-		except Exception as e:
-			flash(f"OCR failed: {e}", "error")
-			return redirect(url_for("upload_page"))
 
-		# Store in DB
 		trip_id = request.form.get('trip_id')
 		trip_id = int(trip_id) if trip_id and trip_id.isdigit() else None
-		conn = get_db_connection(db_path)
-		conn.execute(
-			"INSERT INTO receipts (filename, merchant, date, total, tax, items, raw_text, created_at, trip_id, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-			(
-				filename,
-				data.get("merchant", ""),
-				data.get("date", ""),
-				float(data.get("total") or 0),
-				float(data.get("tax") or 0),
-				str(data.get("items") or []),
-				data.get("raw_text", ""),
-				datetime.utcnow().isoformat(),
-				trip_id,
-				current_user.id,
-			),
-		)
-		conn.commit()
-		conn.close()
 
+		# Preprocessing and OCR run on the worker pool; the browser polls /status
+		job_id = uuid.uuid4().hex
+		future = executor.submit(_process_receipt, original_path, filename, trip_id, current_user.id, app.http_session)
+		with jobs_lock:
+			jobs[job_id] = (current_user.id, future)
+		return redirect(url_for("upload_status", job_id=job_id))
+
+	@app.get("/status/<job_id>")
+	@login_required
+	def upload_status(job_id):
+		"""Show a progress page until the background upload job finishes"""
+		with jobs_lock:
+			job = jobs.get(job_id)
+		if job is None or job[0] != current_user.id:
+			flash("Upload not found or already processed.", "error")
+			return redirect(url_for("history"))
+		future = job[1]
+		if not future.done():
+			return render_template("processing.html", job_id=job_id)
+
+		with jobs_lock:
+			jobs.pop(job_id, None)
+		try:
+			result = future.result()
+		except Exception as e:
+			flash(str(e), "error")
+			return redirect(url_for("upload_page"))
 		return render_template(
 			"results.html",
-			filename=filename,
-			warped_b64=warped_b64,
-			pre_b64=pre_b64,
-			data=data,
+			filename=result["filename"],
+			preview_key=result["preview_key"],
+			data=result["data"],
 		)
 
+	@app.get("/preview/<key>/<which>")
+	@login_required
+	def preview(key, which):
+		"""Serve a processed image shown on the results page"""
+		with previews_lock:
+			images = previews.get(key)
+		if images is None or which not in images:
+			abort(404)
+		image_bytes, mimetype = images[which]
+		response = Response(image_bytes, mimetype=mimetype)
+		response.headers["Cache-Control"] = "private, max-age=600"
+		return response
+
 	@app.get("/uploads/<path:filename>")
 	@login_required
 	def uploaded_file(filename):
-		return send_from_directory(upload_path, filename)
+		if UPLOADS_ACCEL_PREFIX:
+			# Behind nginx: hand the file to an internal location so it is sendfile()'d
+			# straight from disk instead of streamed through Python
+			if safe_join(str(UPLOAD_PATH), filename) is None:
+				abort(404)
+			response = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+			response.headers["X-Accel-Redirect"] = f"{UPLOADS_ACCEL_PREFIX}/{quote(filename)}"
+			return response
+		return send_from_directory(UPLOAD_PATH, filename)
 
 	@app.route("/add_manual_expense", methods=["POST"])
 	@login_required
@@ -376,24 +557,22 @@ def create_app() -> Flask:
 			flash("Invalid numeric values.", "error")
 			return redirect(url_for("upload_page"))
 		
-		conn = get_db_connection(db_path)
-		conn.execute(
-			"INSERT INTO receipts (filename, merchant, date, total, tax, items, raw_text, created_at, trip_id, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-			(
-				None,  # No filename for manual entries
-				merchant,
-				date,
-				total,
-				tax,
-				"[]",  # Empty items list
-				"",  # No raw text
-				datetime.utcnow().isoformat(),
-				trip_id,
-				current_user.id,
-			),
-		)
-		conn.commit()
-		conn.close()
+		with pool.writer() as conn:
+			conn.execute(
+				_INSERT_RECEIPT_SQL,
+				(
+					None,  # No filename for manual entries
+					merchant,
+					date,
+					total,
+					tax,
+					"[]",  # Empty items list
+					"",  # No raw text
+					trip_id,
+					current_user.id,
+				),
+			)
+			conn.commit()
 		flash("Manual expense added successfully.", "success")
 		return redirect(url_for("history"))
 
@@ -401,9 +580,8 @@ def create_app() -> Flask:
 	@login_required
 	def trips():
 		"""Display trips management page"""
-		conn = get_db_connection(db_path)
-		trips_list = conn.execute("SELECT id, name FROM trips WHERE user_id = ? ORDER BY name", (current_user.id,)).fetchall()
-		conn.close()
+		with pool.connection() as conn:
+			trips_list = conn.execute("SELECT id, name FROM trips WHERE user_id = ? ORDER BY name", (current_user.id,)).fetchall()
 		return render_template("trips.html", trips=trips_list)
 
 	@app.route("/trips", methods=["POST"])
@@ -414,10 +592,9 @@ def create_app() -> Flask:
 		if not name:
 			flash("Trip name cannot be empty.", "error")
 			return redirect(url_for("trips"))
-		conn = get_db_connection(db_path)
-		conn.execute("INSERT INTO trips (name, user_id) VALUES (?, ?)", (name, current_user.id))
-		conn.commit()
-		conn.close()
+		with pool.writer() as conn:
+			conn.execute("INSERT INTO trips (name, user_id) VALUES (?, ?)", (name, current_user.id))
+			conn.commit()
 		flash(f"Trip '{name}' created successfully.", "success")
 		return redirect(url_for("trips"))
 
@@ -425,44 +602,43 @@ def create_app() -> Flask:
 	@login_required
 	def trip_detail(trip_id):
 		"""Display trip detail page with calculated totals and date range"""
-		conn = get_db_connection(db_path)
-		# Fetch trip details (ensure it belongs to current user)
-		trip = conn.execute(
-			"SELECT * FROM trips WHERE id = ? AND user_id = ?", (trip_id, current_user.id)
-		).fetchone()
-		if not trip:
-			flash("Trip not found or you don't have permission to view it.", "error")
-			conn.close()
-			return redirect(url_for("trips"))
-		
-		# Fetch all receipts for this trip
-		receipts_list = conn.execute(
-			"""
-			SELECT r.*, t.name as trip_name
-			FROM receipts r
-			LEFT JOIN trips t ON r.trip_id = t.id
-			WHERE r.trip_id = ? AND r.user_id = ?
-			ORDER BY r.date ASC, r.created_at ASC
-			""",
-			(trip_id, current_user.id)
-		).fetchall()
-		
-		# Calculate total spend
-		total_result = conn.execute(
-			"SELECT SUM(total) as total_spend FROM receipts WHERE trip_id = ? AND user_id = ?",
-			(trip_id, current_user.id)
-		).fetchone()
-		total_spend = total_result['total_spend'] if total_result['total_spend'] else 0.0
-		
-		# Calculate date range
-		date_result = conn.execute(
-			"SELECT MIN(date) as start_date, MAX(date) as end_date FROM receipts WHERE trip_id = ? AND user_id = ? AND date IS NOT NULL AND date != ''",
-			(trip_id, current_user.id)
-		).fetchone()
-		start_date = date_result['start_date'] if date_result['start_date'] else None
-		end_date = date_result['end_date'] if date_result['end_date'] else None
-		
-		conn.close()
+		user_id = current_user.id
+		with pool.connection() as conn:
+			# Fetch trip details (ensure it belongs to current user)
+			trip = conn.execute(
+				"SELECT * FROM trips WHERE id = ? AND user_id = ?", (trip_id, user_id)
+			).fetchone()
+			if not trip:
+				flash("Trip not found or you don't have permission to view it.", "error")
+				return redirect(url_for("trips"))
+
+			# Fetch all receipts for this trip
+			receipts_list = conn.execute(
+				"""
+				SELECT r.id, r.filename, r.merchant, r.date, r.total, r.tax, r.trip_id, t.name as trip_name
+				FROM receipts r
+				LEFT JOIN trips t ON r.trip_id = t.id
+				WHERE r.trip_id = ? AND r.user_id = ?
+				ORDER BY r.date ASC, r.created_at ASC
+				""",
+				(trip_id, user_id)
+			).fetchall()
+
+			# Calculate total spend
+			total_result = conn.execute(
+				"SELECT SUM(total) as total_spend FROM receipts WHERE trip_id = ? AND user_id = ?",
+				(trip_id, user_id)
+			).fetchone()
+			total_spend = total_result['total_spend'] if total_result['total_spend'] else 0.0
+
+			# Calculate date range
+			date_result = conn.execute(
+				"SELECT MIN(date) as start_date, MAX(date) as end_date FROM receipts WHERE trip_id = ? AND user_id = ? AND date IS NOT NULL AND date != ''",
+				(trip_id, user_id)
+			).fetchone()
+			start_date = date_result['start_date'] if date_result['start_date'] else None
+			end_date = date_result['end_date'] if date_result['end_date'] else None
+
 		return render_template(
 			"trip_detail.html",
 			trip=trip,
@@ -476,16 +652,14 @@ def create_app() -> Flask:
 	@login_required
 	def edit_receipt(id):
 		"""Display edit receipt form"""
-		conn = get_db_connection(db_path)
-		receipt = conn.execute(
-			"SELECT * FROM receipts WHERE id = ? AND user_id = ?", (id, current_user.id)
-		).fetchone()
-		if not receipt:
-			flash("Receipt not found or you don't have permission to edit it.", "error")
-			conn.close()
-			return redirect(url_for("history"))
-		trips_list = conn.execute("SELECT id, name FROM trips WHERE user_id = ? ORDER BY name", (current_user.id,)).fetchall()
-		conn.close()
+		user_id = current_user.id
+		# Both lookups run back to back on one pooled connection
+		with pool.connection() as conn:
+			receipt = owned_receipt(conn, id, user_id)
+			if not receipt:
+				flash("Receipt not found or you don't have permission to edit it.", "error")
+				return redirect(url_for("history"))
+			trips_list = conn.execute("SELECT id, name FROM trips WHERE user_id = ? ORDER BY name", (user_id,)).fetchall()
 		return render_template("edit_receipt.html", receipt=receipt, trips=trips_list)
 
 	@app.route("/edit/<int:id>", methods=["POST"])
@@ -506,13 +680,15 @@ def create_app() -> Flask:
 			flash("Invalid numeric values.", "error")
 			return redirect(url_for("edit_receipt", id=id))
 		
-		conn = get_db_connection(db_path)
-		conn.execute(
-			"UPDATE receipts SET merchant = ?, date = ?, total = ?, tax = ?, trip_id = ? WHERE id = ? AND user_id = ?",
-			(merchant, date, total, tax, trip_id, id, current_user.id)
-		)
-		conn.commit()
-		conn.close()
+		with pool.writer() as conn:
+			cursor = conn.execute(
+				"UPDATE receipts SET merchant = ?, date = ?, total = ?, tax = ?, trip_id = ? WHERE id = ? AND user_id = ?",
+				(merchant, date, total, tax, trip_id, id, current_user.id)
+			)
+			conn.commit()
+		if cursor.rowcount == 0:
+			flash("Receipt not found or you don't have permission to edit it.", "error")
+			return redirect(url_for("history"))
 		flash("Receipt updated successfully.", "success")
 		return redirect(url_for("history"))
 
@@ -520,10 +696,12 @@ def create_app() -> Flask:
 	@login_required
 	def delete_receipt(id):
 		"""Delete a receipt"""
-		conn = get_db_connection(db_path)
-		conn.execute("DELETE FROM receipts WHERE id = ? AND user_id = ?", (id, current_user.id))
-		conn.commit()
-		conn.close()
+		with pool.writer() as conn:
+			cursor = conn.execute("DELETE FROM receipts WHERE id = ? AND user_id = ?", (id, current_user.id))
+			conn.commit()
+		if cursor.rowcount == 0:
+			flash("Receipt not found or you don't have permission to delete it.", "error")
+			return redirect(url_for("history"))
 		flash("Receipt deleted successfully.", "success")
 		return redirect(url_for("history"))
 
@@ -532,11 +710,10 @@ def create_app() -> Flask:
 	@admin_required
 	def admin_drivers_list():
 		"""Admin view: list of all drivers"""
-		conn = get_db_connection(db_path)
-		drivers = conn.execute(
-			"SELECT id, username FROM users WHERE role != 'admin' ORDER BY username"
-		).fetchall()
-		conn.close()
+		with pool.connection() as conn:
+			drivers = conn.execute(
+				"SELECT id, username FROM users WHERE role != 'admin' ORDER BY username"
+			).fetchall()
 		return render_template("admin_drivers_list.html", drivers=drivers)
 
 	@app.route("/drivers/<int:user_id>")
@@ -544,62 +721,59 @@ def create_app() -> Flask:
 	@admin_required
 	def admin_driver_detail(user_id):
 		"""Admin view: detailed view of a specific driver's trips with year filter"""
-		conn = get_db_connection(db_path)
-		
-		# Fetch the driver/user
-		user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-		if not user:
-			flash("Driver not found.", "error")
-			conn.close()
-			return redirect(url_for("admin_drivers_list"))
-		
-		# Get available years from receipts for this user
-		years_result = conn.execute(
-			"""
-			SELECT DISTINCT strftime('%Y', created_at) as year
-			FROM receipts
-			WHERE user_id = ? AND created_at IS NOT NULL AND created_at != ''
-			ORDER BY year DESC
-			""",
-			(user_id,)
-		).fetchall()
-		available_years = [row['year'] for row in years_result if row['year']]
-		
-		# Get year filter from query parameter
-		selected_year = request.args.get('year')
-		
-		# Build query for trips with optional year filter
-		if selected_year and selected_year in available_years:
-			# Fetch trips that have receipts in the selected year
-			trips_query = """
-				SELECT DISTINCT t.id, t.name,
-					COALESCE(SUM(r.total), 0) as total_spend,
-					MIN(r.date) as start_date,
-					MAX(r.date) as end_date
-				FROM trips t
-				LEFT JOIN receipts r ON t.id = r.trip_id AND r.user_id = ? AND strftime('%Y', r.created_at) = ?
-				WHERE t.user_id = ?
-				GROUP BY t.id, t.name
-				HAVING COUNT(r.id) > 0
-				ORDER BY t.name
-			"""
-			trips = conn.execute(trips_query, (user_id, selected_year, user_id)).fetchall()
-		else:
-			# Fetch all trips for this user with their totals
-			trips_query = """
-				SELECT t.id, t.name,
-					COALESCE(SUM(r.total), 0) as total_spend,
-					MIN(r.date) as start_date,
-					MAX(r.date) as end_date
-				FROM trips t
-				LEFT JOIN receipts r ON t.id = r.trip_id AND r.user_id = ?
-				WHERE t.user_id = ?
-				GROUP BY t.id, t.name
-				ORDER BY t.name
-			"""
-			trips = conn.execute(trips_query, (user_id, user_id)).fetchall()
-		
-		conn.close()
+		with pool.connection() as conn:
+			# Fetch the driver/user
+			user = conn.execute("SELECT id, username, truck_number FROM users WHERE id = ?", (user_id,)).fetchone()
+			if not user:
+				flash("Driver not found.", "error")
+				return redirect(url_for("admin_drivers_list"))
+
+			# Get available years from receipts for this user
+			years_result = conn.execute(
+				"""
+				SELECT DISTINCT strftime('%Y', created_at) as year
+				FROM receipts
+				WHERE user_id = ? AND created_at IS NOT NULL AND created_at != ''
+				ORDER BY year DESC
+				""",
+				(user_id,)
+			).fetchall()
+			available_years = [row['year'] for row in years_result if row['year']]
+
+			# Get year filter from query parameter
+			selected_year = request.args.get('year')
+
+			# Build query for trips with optional year filter
+			if selected_year and selected_year in available_years:
+				# Fetch trips that have receipts in the selected year
+				trips_query = """
+					SELECT DISTINCT t.id, t.name,
+						COALESCE(SUM(r.total), 0) as total_spend,
+						MIN(r.date) as start_date,
+						MAX(r.date) as end_date
+					FROM trips t
+					LEFT JOIN receipts r ON t.id = r.trip_id AND r.user_id = ? AND strftime('%Y', r.created_at) = ?
+					WHERE t.user_id = ?
+					GROUP BY t.id, t.name
+					HAVING COUNT(r.id) > 0
+					ORDER BY t.name
+				"""
+				trips = conn.execute(trips_query, (user_id, selected_year, user_id)).fetchall()
+			else:
+				# Fetch all trips for this user with their totals
+				trips_query = """
+					SELECT t.id, t.name,
+						COALESCE(SUM(r.total), 0) as total_spend,
+						MIN(r.date) as start_date,
+						MAX(r.date) as end_date
+					FROM trips t
+					LEFT JOIN receipts r ON t.id = r.trip_id AND r.user_id = ?
+					WHERE t.user_id = ?
+					GROUP BY t.id, t.name
+					ORDER BY t.name
+				"""
+				trips = conn.execute(trips_query, (user_id, user_id)).fetchall()
+
 		return render_template(
 			"admin_driver_detail.html",
 			driver=user,
@@ -613,36 +787,34 @@ def create_app() -> Flask:
 	@admin_required
 	def admin_reports():
 		"""Admin view: fleet reports with yearly and quarterly totals"""
-		conn = get_db_connection(db_path)
-		
-		# Yearly totals
-		yearly_totals = conn.execute(
-			"""
-			SELECT 
-				strftime('%Y', date) as year, 
-				SUM(total) as total_spend 
-			FROM receipts 
-			WHERE date IS NOT NULL AND date != '' 
-			GROUP BY year 
-			ORDER BY year DESC
-			"""
-		).fetchall()
-		
-		# Quarterly totals
-		quarterly_totals = conn.execute(
-			"""
-			SELECT 
-				strftime('%Y', date) as year, 
-				(CAST(strftime('%m', date) AS INTEGER) - 1) / 3 + 1 as quarter, 
-				SUM(total) as total_spend 
-			FROM receipts 
-			WHERE date IS NOT NULL AND date != '' 
-			GROUP BY year, quarter 
-			ORDER BY year DESC, quarter DESC
-			"""
-		).fetchall()
-		
-		conn.close()
+		with pool.connection() as conn:
+			# Yearly totals
+			yearly_totals = conn.execute(
+				"""
+				SELECT 
+					strftime('%Y', date) as year, 
+					SUM(total) as total_spend 
+				FROM receipts 
+				WHERE date IS NOT NULL AND date != '' 
+				GROUP BY year 
+				ORDER BY year DESC
+				"""
+			).fetchall()
+
+			# Quarterly totals
+			quarterly_totals = conn.execute(
+				"""
+				SELECT 
+					strftime('%Y', date) as year, 
+					(CAST(strftime('%m', date) AS INTEGER) - 1) / 3 + 1 as quarter, 
+					SUM(total) as total_spend 
+				FROM receipts 
+				WHERE date IS NOT NULL AND date != '' 
+				GROUP BY year, quarter 
+				ORDER BY year DESC, quarter DESC
+				"""
+			).fetchall()
+
 		return render_template(
 			"admin_reports.html",
 			yearly_totals=yearly_totals,
@@ -652,9 +824,7 @@ def create_app() -> Flask:
 	return app
 
 
-app = create_app()
-
 if __name__ == "__main__":
-	app.run(debug=True)
+	create_app().run(debug=True)
 
 
@@ -26,6 +26,8 @@ class Config:
 	AZURE_CV_ENDPOINT: str
 	AZURE_CV_KEY: str
 	MAX_CONTENT_LENGTH: int = 20 * 1024 * 1024  # 20MB
+	OCR_WORKERS: int = 10
+	UPLOADS_ACCEL_PREFIX: str = ""
 
 	@classmethod
 	def from_env(cls) -> "Config":
@@ -35,18 +37,23 @@ class Config:
 		db_path = os.getenv("DATABASE_PATH", "trip_tally.db")
 		endpoint = os.getenv("AZURE_CV_ENDPOINT", "")
 		key = os.getenv("AZURE_CV_KEY", "")
+		workers = int(os.getenv("OCR_WORKERS", "10"))
+		accel_prefix = os.getenv("UPLOADS_ACCEL_PREFIX", "")
 		return cls(
 			SECRET_KEY=secret,
 			UPLOAD_FOLDER=upload,
 			DATABASE_PATH=db_path,
 			AZURE_CV_ENDPOINT=endpoint,
 			AZURE_CV_KEY=key,
+			OCR_WORKERS=workers,
+			UPLOADS_ACCEL_PREFIX=accel_prefix,
 		)
 
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp", "bmp", "tif", "tiff"}
+_ALLOWED_SUFFIXES = tuple("." + e for e in ALLOWED_EXTENSIONS)
 
 def allowed_file(filename: str) -> bool:
-	return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+	return filename.lower().endswith(_ALLOWED_SUFFIXES)
 
 
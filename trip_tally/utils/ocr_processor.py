@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import json
 import os
@@ -5,76 +6,211 @@ import re
 import time
 from typing import Dict, List, Tuple
 
+import aiohttp
+import cv2
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+
+from utils.image_processing import preprocess_receipt
+
+
+# Receipt parsing patterns, compiled once at import
+_MERCHANT_SKIP = re.compile(r"(total|visa|mastercard|debit|credit|invoice|receipt)", re.I)
+_DATE_PATTERNS = [
+	re.compile(p, re.I)
+	for p in (
+		r"\b(\d{4}[-/](?:0?[1-9]|1[0-2])[-/](?:0?[1-9]|[12]\d|3[01]))\b",  # YYYY-MM-DD
+		r"\b((?:0?[1-9]|1[0-2])[-/](?:0?[1-9]|[12]\d|3[01])[-/]\d{2,4})\b",  # MM/DD/YYYY
+		r"\b((?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+\d{1,2},\s+\d{4})\b",
+	)
+]
+_AMOUNT = re.compile(r"\$?\s*([0-9]+(?:\.[0-9]{2})?)")
+_TOTAL_KW = re.compile(r"\b(total|amount due|balance due|grand total)\b", re.I)
+_TAX_KW = re.compile(r"\b(tax|hst|gst|vat)\b", re.I)
+_STRICT_DOLLAR = re.compile(r"\$\s*([0-9]+\.[0-9]{2})")  # requires a '$' sign to be safe
+_ITEM_SKIP = re.compile(r"\b(total|tax)\b", re.I)
+
+_JPEG_MAGIC = b"\xff\xd8"
+_PNG_MAGIC = b"\x89PNG"
+# Azure Read's request size limit on the free tier
+_MAX_PASSTHROUGH_BYTES = 4 * 1024 * 1024
+
+
+def _ensure_jpeg(image_bytes: bytes) -> bytes:
+	"""Re-encode bulky uploads as JPEG to cut the bytes sent to Azure.
+
+	JPEG passes through untouched. PNG under the size limit does too, since the app
+	sends lossless binarized PNGs that JPEG artifacts would hurt. Anything else
+	(BMP, TIFF, oversized PNG) is re-encoded at quality 85.
+	"""
+	if image_bytes.startswith(_JPEG_MAGIC):
+		return image_bytes
+	if image_bytes.startswith(_PNG_MAGIC) and len(image_bytes) <= _MAX_PASSTHROUGH_BYTES:
+		return image_bytes
+	img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+	if img is None:
+		return image_bytes
+	ok, enc = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
+	return enc.tobytes() if ok else image_bytes
 
 
 class AzureOCRClient:
-	def __init__(self, endpoint: str, key: str, api_version: str = "v3.2"):
+	def __init__(self, endpoint: str, key: str, api_version: str = "v3.2", session: requests.Session = None):
 		self.endpoint = endpoint.rstrip("/")
 		self.key = key
 		self.api_version = api_version
+		# Keep-alive session so the analyze POST and every status poll reuse one TLS
+		# connection. A caller's session (e.g. the app-wide pool) is used as is.
+		self._owns_session = session is None
+		if session is None:
+			session = requests.Session()
+			session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+		self._session = session
+		self._auth_headers = {"Ocp-Apim-Subscription-Key": key}
+
+	def close(self):
+		"""Release the HTTP session if this client created it."""
+		if self._owns_session:
+			self._session.close()
 
 	def analyze_image_bytes(self, image_bytes: bytes, timeout_seconds: int = 30) -> List[str]:
 		"""Send image to Azure Read Analyze and return list of OCR lines when done."""
+		image_bytes = _ensure_jpeg(image_bytes)
 		url = f"{self.endpoint}/vision/{self.api_version}/read/analyze"
 		headers = {
-			"Ocp-Apim-Subscription-Key": self.key,
+			**self._auth_headers,
 			"Content-Type": "application/octet-stream",
 		}
-		resp = requests.post(url, headers=headers, data=image_bytes, timeout=timeout_seconds)
+		resp = self._session.post(url, headers=headers, data=image_bytes, timeout=timeout_seconds)
 		if resp.status_code not in (202, 200):
 			raise RuntimeError(f"Azure analyze failed: {resp.status_code} {resp.text}")
 		operation_location = resp.headers.get("operation-location")
 		if not operation_location:
 			raise RuntimeError("No operation-location header returned by Azure Read API")
 
-		# Poll for result
-		for _ in range(60):  # up to ~60 * 1s = 60s
-			res = requests.get(operation_location, headers={"Ocp-Apim-Subscription-Key": self.key}, timeout=timeout_seconds)
+		# Poll for result. Most reads finish in under a second, so start at 200ms and
+		# back off to 1.5s; the overall budget stays ~60s at the default timeout.
+		delay = 0.2
+		deadline = time.monotonic() + timeout_seconds * 2
+		while time.monotonic() < deadline:
+			res = self._session.get(operation_location, headers=self._auth_headers, timeout=timeout_seconds)
 			if res.status_code != 200:
-				time.sleep(1)
+				time.sleep(delay)
+				delay = min(delay * 1.5, 1.5)
 				continue
 			data = res.json()
 			status = data.get("status")
 			if status == "succeeded":
-				lines: List[str] = []
-				analyze_result = data.get("analyzeResult", {})
-				for read_result in analyze_result.get("readResults", []):
-					for line in read_result.get("lines", []):
-						text = line.get("text", "").strip()
-						if text:
-							lines.append(text)
-				return lines
+				return _read_result_lines(data)
 			elif status in ("failed", "error"):
 				raise RuntimeError("Azure Read operation failed")
-			time.sleep(1)
+			time.sleep(delay)
+			delay = min(delay * 1.5, 1.5)
 		raise TimeoutError("Azure Read operation timed out")
 
 
+class AsyncAzureOCRClient:
+	"""asyncio counterpart of AzureOCRClient for running many reads concurrently.
+
+	The caller owns the aiohttp session so one connection pool serves all reads.
+	"""
+
+	def __init__(self, endpoint: str, key: str, session: aiohttp.ClientSession, api_version: str = "v3.2"):
+		self.endpoint = endpoint.rstrip("/")
+		self.key = key
+		self.api_version = api_version
+		self._session = session
+		self._auth_headers = {"Ocp-Apim-Subscription-Key": key}
+
+	async def analyze_image_bytes(self, image_bytes: bytes, timeout_seconds: int = 30) -> List[str]:
+		"""Send image to Azure Read Analyze and return list of OCR lines when done."""
+		image_bytes = _ensure_jpeg(image_bytes)
+		url = f"{self.endpoint}/vision/{self.api_version}/read/analyze"
+		headers = {
+			**self._auth_headers,
+			"Content-Type": "application/octet-stream",
+		}
+		timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+		async with self._session.post(url, headers=headers, data=image_bytes, timeout=timeout) as resp:
+			if resp.status not in (202, 200):
+				raise RuntimeError(f"Azure analyze failed: {resp.status} {await resp.text()}")
+			operation_location = resp.headers.get("operation-location")
+		if not operation_location:
+			raise RuntimeError("No operation-location header returned by Azure Read API")
+
+		# Same backoff schedule as the sync client
+		delay = 0.2
+		deadline = time.monotonic() + timeout_seconds * 2
+		while time.monotonic() < deadline:
+			async with self._session.get(operation_location, headers=self._auth_headers, timeout=timeout) as res:
+				data = await res.json() if res.status == 200 else {}
+			status = data.get("status")
+			if status == "succeeded":
+				return _read_result_lines(data)
+			elif status in ("failed", "error"):
+				raise RuntimeError("Azure Read operation failed")
+			await asyncio.sleep(delay)
+			delay = min(delay * 1.5, 1.5)
+		raise TimeoutError("Azure Read operation timed out")
+
+
+def _read_result_lines(data: Dict) -> List[str]:
+	"""Collect the non-empty text lines from a succeeded Read result."""
+	lines: List[str] = []
+	analyze_result = data.get("analyzeResult", {})
+	for read_result in analyze_result.get("readResults", []):
+		for line in read_result.get("lines", []):
+			text = line.get("text", "").strip()
+			if text:
+				lines.append(text)
+	return lines
+
+
+def _scan_lines(lines: List[str]) -> Tuple[int, int, int]:
+	"""Return the indices of the merchant, total and tax lines (-1 when absent).
+
+	One pass over the lines; each search stops once its line is found.
+	Merchant: first non-empty line, excluding common words.
+	"""
+	merchant_idx = total_idx = tax_idx = -1
+	for i, line in enumerate(lines):
+		if merchant_idx < 0:
+			clean = line.strip()
+			if clean and not _MERCHANT_SKIP.search(clean):
+				merchant_idx = i
+		if total_idx < 0 and _TOTAL_KW.search(line):
+			total_idx = i
+		if tax_idx < 0 and _TAX_KW.search(line):
+			tax_idx = i
+		if merchant_idx >= 0 and total_idx >= 0 and tax_idx >= 0:
+			break
+	return merchant_idx, total_idx, tax_idx
+
+
+def _dollar_amounts(lines: List[str]) -> List[float]:
+	"""Return every amount written with a '$' (a line may hold several prices)."""
+	values = []
+	for line in lines:
+		for m in _STRICT_DOLLAR.findall(line):
+			try:
+				values.append(float(m))
+			except ValueError:
+				continue
+	return values
+
+
 def parse_receipt_text(lines: List[str]) -> Dict:
 	"""Very basic parsing heuristics to extract merchant, date, total, tax, items."""
 	joined = "\n".join(lines)
 
-	# Merchant: first non-empty line, excluding common words
-	merchant = ""
-	for line in lines:
-		clean = line.strip()
-		if not clean:
-			continue
-		if re.search(r"(total|visa|mastercard|debit|credit|invoice|receipt)", clean, re.I):
-			continue
-		merchant = clean
-		break
+	merchant_idx, total_idx, tax_idx = _scan_lines(lines)
+	merchant = lines[merchant_idx].strip() if merchant_idx >= 0 else ""
 
 	# Date: attempt multiple formats
-	date_patterns = [
-		r"\b(\d{4}[-/](?:0?[1-9]|1[0-2])[-/](?:0?[1-9]|[12]\d|3[01]))\b",  # YYYY-MM-DD
-		r"\b((?:0?[1-9]|1[0-2])[-/](?:0?[1-9]|[12]\d|3[01])[-/]\d{2,4})\b",  # MM/DD/YYYY
-		r"\b((?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+\d{1,2},\s+\d{4})\b",
-	]
 	date = ""
-	for pat in date_patterns:
-		m = re.search(pat, joined, re.I)
+	for pat in _DATE_PATTERNS:
+		m = pat.search(joined)
 		if m:
 			date = m.group(1)
 			break
@@ -82,15 +218,12 @@ def parse_receipt_text(lines: List[str]) -> Dict:
 # ... (keep merchant and date logic the same)
 
 	# --- IMPROVED TOTAL EXTRACTION ---
-	amount_re = r"\$?\s*([0-9]+(?:\.[0-9]{2})?)"
-	
 	# Strategy 1: Keyword Search (High Confidence)
 	# We look for lines explicitly labeled "Total", "Balance", etc.
-	total_keywords = r"\b(total|amount due|balance due|grand total)\b"
-	line_with_total = next((l for l in lines if re.search(total_keywords, l, re.I)), "")
+	line_with_total = lines[total_idx] if total_idx >= 0 else ""
 	
 	def extract_amount(line: str) -> float:
-		m = re.search(amount_re, line)
+		m = _AMOUNT.search(line)
 		if m:
 			try:
 				return float(m.group(1))
@@ -103,19 +236,7 @@ def parse_receipt_text(lines: List[str]) -> Dict:
 	# Strategy 2: Largest Dollar Amount (Fallback)
 	# If Strategy 1 failed (total_val is 0), find the largest number preceded by a '$'
 	if total_val == 0.0:
-		all_dollar_values = []
-		# Regex requiring a '$' sign to be safe
-		strict_dollar_re = r"\$\s*([0-9]+\.[0-9]{2})"
-		
-		for line in lines:
-			# Find all matches in the line (in case multiple prices are on one line)
-			matches = re.findall(strict_dollar_re, line)
-			for m in matches:
-				try:
-					all_dollar_values.append(float(m))
-				except ValueError:
-					continue
-		
+		all_dollar_values = _dollar_amounts(lines)
 		if all_dollar_values:
 			total_val = max(all_dollar_values)
 
@@ -123,22 +244,17 @@ def parse_receipt_text(lines: List[str]) -> Dict:
 	total = str(total_val) if total_val > 0 else ""
 	
 	# Tax Logic (Keep existing)
-	line_with_tax = next((l for l in lines if re.search(r"\b(tax|hst|gst|vat)\b", l, re.I)), "")
+	line_with_tax = lines[tax_idx] if tax_idx >= 0 else ""
 	tax = str(extract_amount(line_with_tax)) if line_with_tax else ""
 
 	# ... (Rest of function)
 
 	# Items: heuristic - lines between merchant and total that look like item descriptions with an amount
 	items: List[Tuple[str, str]] = []
-	if merchant and line_with_total:
-		try:
-			start_idx = lines.index(merchant)
-		except ValueError:
-			start_idx = 0
-		end_idx = lines.index(line_with_total) if line_with_total in lines else len(lines)
-		for l in lines[start_idx + 1:end_idx]:
-			m = re.search(amount_re, l)
-			if m and not re.search(r"\b(total|tax)\b", l, re.I):
+	if merchant_idx >= 0 and total_idx >= 0:
+		for l in lines[merchant_idx + 1:total_idx]:
+			m = _AMOUNT.search(l)
+			if m and not _ITEM_SKIP.search(l):
 				items.append((l.strip(), m.group(1)))
 
 	return {
@@ -151,10 +267,46 @@ def parse_receipt_text(lines: List[str]) -> Dict:
 	}
 
 
-def extract_receipt_data(image_bytes: bytes, endpoint: str, key: str) -> Dict:
-	client = AzureOCRClient(endpoint, key)
-	lines = client.analyze_image_bytes(image_bytes)
+def extract_receipt_data(image_bytes: bytes, endpoint: str, key: str, session: requests.Session = None) -> Dict:
+	client = AzureOCRClient(endpoint, key, session=session)
+	try:
+		lines = client.analyze_image_bytes(image_bytes)
+	finally:
+		client.close()
 	data = parse_receipt_text(lines)
 	return data
 
 
+def extract_receipt_data_from_bytes(image_bytes: bytes, endpoint: str, key: str, session: requests.Session = None) -> Dict:
+	"""Crop and straighten an encoded receipt photo locally, then OCR the result.
+
+	The photo is decoded once and that array drives both contour detection and the
+	warp. Azure receives only the top-down receipt as JPEG, which is smaller than
+	the original upload and free of background clutter.
+	"""
+	img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+	if img is None:
+		raise ValueError("Could not decode image")
+	warped, _ = preprocess_receipt(img)
+	ok, enc = cv2.imencode(".jpg", warped, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+	if not ok:
+		raise RuntimeError("Could not encode warped receipt")
+	return extract_receipt_data(enc.tobytes(), endpoint, key, session=session)
+
+
+async def extract_receipt_data_batch(images: List[bytes], endpoint: str, key: str, concurrency: int = 8) -> List[Dict]:
+	"""OCR several receipts concurrently, at most `concurrency` Azure reads in flight.
+
+	Total time is roughly that of the slowest read rather than the sum of all of
+	them. Results are returned in the same order as `images`.
+	"""
+	semaphore = asyncio.Semaphore(concurrency)
+	async with aiohttp.ClientSession() as session:
+		client = AsyncAzureOCRClient(endpoint, key, session)
+
+		async def extract_one(image_bytes: bytes) -> Dict:
+			async with semaphore:
+				lines = await client.analyze_image_bytes(image_bytes)
+			return parse_receipt_text(lines)
+
+		return await asyncio.gather(*(extract_one(image_bytes) for image_bytes in images))
@@ -0,0 +1,9 @@
+"""WSGI entry point, e.g. waitress-serve --listen=0.0.0.0:8000 wsgi:app
+
+Importing app.py no longer builds the application, so this is the one place
+create_app() runs for a served process.
+"""
+
+from app import create_app
+
+app = create_app()